@@ -1,9 +1,6 @@
+import asyncio
 import streamlit as st
-from main import upload, search, delete_all
-import os
-import pytesseract
-
-pytesseract.pytesseract.tesseract_cmd = os.getenv("TESSERACT_CMD", "/usr/bin/tesseract")
+from main import upload, search, delete_all, setup_weaviate_schema
 
 st.set_page_config(
     page_title="Document RAG System",
@@ -11,6 +8,10 @@ st.set_page_config(
     layout="wide"
 )
 
+# The FastAPI lifespan doesn't run here, so make sure the collection exists;
+# after the first run this is a no-op
+setup_weaviate_schema()
+
 # Sidebar for app navigation
 st.sidebar.title("📚 Document RAG System")
 page = st.sidebar.radio("Navigation", ["Upload Documents", "Search Documents"])
@@ -100,7 +101,7 @@ if page == "Upload Documents":
             st.info(f"Selected file: {uploaded_file.name}")
             if st.button("Upload Document", use_container_width=True):
                 with st.spinner("Uploading and processing document..."):
-                    result = upload(uploaded_file)
+                    result = asyncio.run(upload(uploaded_file))
                     
                     if result.get("success"):
                         st.success(f"Document processed successfully! Created {result['chunks']} chunks.")
@@ -0,0 +1,17 @@
+import multiprocessing
+import os
+
+# Run with: gunicorn main:app
+# Each worker has its own event loop, embedding model and OCR process pool, so
+# CPU-heavy uploads in one worker don't stall requests handled by the others.
+# Workers are capped because every one of them loads its own copy of the model;
+# set WEB_CONCURRENCY to override.
+cpu_count = multiprocessing.cpu_count()
+
+bind = "0.0.0.0:8000"
+workers = max(1, int(os.getenv("WEB_CONCURRENCY", min(cpu_count, 4))))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Split the cores between the workers' OCR pools instead of giving each one all of
+# them; workers inherit this from the master unless OCR_WORKERS is already set
+os.environ.setdefault("OCR_WORKERS", str(max(1, cpu_count // workers)))
@@ -1,21 +1,38 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
-import json
+import hashlib
 import docx
+import logging
+import multiprocessing
 import os
 import shutil
 import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from itertools import repeat
+from typing import IO, Union
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import weaviate
 from weaviate.classes.config import Property, DataType, Configure
+from weaviate.classes.data import DataObject
 from weaviate.classes.init import Auth
 from weaviate.classes.query import Filter, MetadataQuery
+from weaviate.exceptions import WeaviateBaseError
+from weaviate.util import generate_uuid5
 import pdfplumber
-import pytesseract
+from sentence_transformers import SentenceTransformer
+from ocr import ocr_page
 
 load_dotenv()
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 wcd_key = os.getenv("WEAVIATE_API_KEY")
 wcd_url = os.getenv("WEAVIATE_URL")
 
@@ -24,10 +41,41 @@ if not wcd_key or not wcd_url:
         "Missing required environment variables. Please ensure WEAVIATE_API_KEY and WEAVIATE_URL are set."
     )
 
-pytesseract.pytesseract.tesseract_cmd = os.getenv("TESSERACT_CMD", "/usr/bin/tesseract")
+# Pages whose embedded text layer is shorter than this are treated as scanned and OCR'd
+MIN_TEXT_LAYER_CHARS = 50
+
+EMBEDDING_MODEL = "Snowflake/snowflake-arctic-embed-m-v1.5"
+# int8 dynamically quantized export shipped in the model repo, for fast CPU inference
+EMBEDDING_ONNX_FILE = "onnx/model_quantized.onnx"
+
+# A single client is shared by every request so the TLS handshake and gRPC channel
+# setup are paid once per process instead of once per call
+weaviate_client = None
+weaviate_client_lock = threading.Lock()
+
+# Set once the Weaviate collections are known to exist, so repeat setup calls are free
+schema_ready = False
+
+# Scanned pages from every upload in this process share one pool of OCR workers
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", os.cpu_count() or 1))
+ocr_pool = None
+ocr_pool_lock = threading.Lock()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Don't fail the worker's boot if Weaviate is briefly unreachable during a deploy;
+    # schema_ready stays False and the next request creates the schema instead
+    try:
+        setup_weaviate_schema()
+    except WeaviateBaseError as e:
+        logger.warning("Weaviate unavailable at startup, deferring schema setup: %s", e)
+    yield
+    close_ocr_pool()
+    close_weaviate_client()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -40,24 +88,108 @@ app.add_middleware(
 wcd_key = os.getenv("WEAVIATE_API_KEY")
 wcd_url = os.getenv("WEAVIATE_URL")
 
-def get_weaviate_client():    
-    client = weaviate.connect_to_weaviate_cloud(
-        cluster_url=wcd_url,                    
-        auth_credentials=Auth.api_key(wcd_key), 
+@lru_cache(maxsize=1)
+def get_embedding_model():
+    # All vectors are computed here on the ONNX runtime; the collection has no vectorizer
+    return SentenceTransformer(
+        EMBEDDING_MODEL,
+        backend="onnx",
+        model_kwargs={"file_name": EMBEDDING_ONNX_FILE}
     )
-    return client
+
+@lru_cache(maxsize=10000)
+def embed_query(query: str) -> tuple:
+    # Repeat queries skip the model entirely; hit/miss counts are in embed_query.cache_info()
+    return tuple(get_embedding_model().encode(query, prompt_name="query", normalize_embeddings=True).tolist())
+
+def get_weaviate_client():    
+    global weaviate_client
+    with weaviate_client_lock:
+        if weaviate_client is None or not weaviate_client.is_connected():
+            weaviate_client = weaviate.connect_to_weaviate_cloud(
+                cluster_url=wcd_url,                    
+                auth_credentials=Auth.api_key(wcd_key), 
+            )
+        return weaviate_client
+
+def close_weaviate_client():
+    global weaviate_client
+    with weaviate_client_lock:
+        if weaviate_client is not None:
+            weaviate_client.close()
+            weaviate_client = None
+
+def get_ocr_pool() -> ProcessPoolExecutor:
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is None:
+            # Forking here would copy the live gRPC channel and onnxruntime threads into
+            # the child; spawned workers start clean and only import ocr.py
+            ocr_pool = ProcessPoolExecutor(
+                max_workers=OCR_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return ocr_pool
+
+def reset_ocr_pool(pool: ProcessPoolExecutor):
+    # Only drop the pool if another upload hasn't already replaced it
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is pool:
+            ocr_pool = None
+    pool.shutdown(wait=False)
+
+def run_ocr(file_path: str, page_indexes: list) -> list:
+    for attempt in range(2):
+        pool = get_ocr_pool()
+        try:
+            return list(pool.map(ocr_page, repeat(file_path), page_indexes))
+        except BrokenProcessPool:
+            # A crashed worker (e.g. on a malformed page) breaks the whole pool, so replace
+            # it for later uploads and retry this document once on a fresh one
+            reset_ocr_pool(pool)
+            if attempt:
+                raise
+
+def close_ocr_pool():
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is not None:
+            ocr_pool.shutdown()
+            ocr_pool = None
+
+def chunk_uuid(document_name: str, chunk_id: int) -> str:
+    # Deterministic ids let a chunk's neighbours be fetched by id instead of storing their text
+    return generate_uuid5(f"{document_name}#{chunk_id}")
+
+def document_file_uuid(document_name: str, digest: str) -> str:
+    return generate_uuid5(f"{document_name}#{digest}")
 
 def setup_weaviate_schema():
+    global schema_ready
+    if schema_ready:
+        return
     client= get_weaviate_client()
     if not client.collections.exists("DocumentChunk"):
         client.collections.create(
             "DocumentChunk",
             description="Stores document text chunks with embeddings",
             vectorizer_config=[
-                Configure.NamedVectors.text2vec_weaviate(
+                Configure.NamedVectors.none(
                     name="document_vector",
-                    source_properties=["text"],
-                    model="Snowflake/snowflake-arctic-embed-m-v1.5",
+                    # Dynamic ef (ef=-1) scales the candidate list with the query limit
+                    # but clamps it to 64-128, keeping the per-query scan budget small
+                    vector_index_config=Configure.VectorIndex.hnsw(
+                        ef=-1,
+                        dynamic_ef_min=64,
+                        dynamic_ef_max=128,
+                        dynamic_ef_factor=8,
+                        ef_construction=128,
+                        max_connections=16,
+                        # Scalar quantization keeps int8 codes in memory (4x smaller than
+                        # FP32) and rescores the top candidates with the full vectors
+                        quantizer=Configure.VectorIndex.Quantizer.sq(rescore_limit=200),
+                    ),
                 )
             ],
             properties=[
@@ -66,16 +198,40 @@ def setup_weaviate_schema():
                 Property(name="document_type", data_type=DataType.TEXT),
                 Property(name="total_chunks", data_type=DataType.INT),
                 Property(name="text", data_type=DataType.TEXT),
-                Property(name="context_before", data_type=DataType.TEXT),  
-                Property(name="context_after", data_type=DataType.TEXT)    
+                Property(name="context_before_id", data_type=DataType.INT),  
+                Property(name="context_after_id", data_type=DataType.INT)    
+            ]
+        )
+    if not client.collections.exists("DocumentFile"):
+        client.collections.create(
+            "DocumentFile",
+            description="Content hashes of ingested files, used to skip identical re-uploads",
+            vectorizer_config=Configure.Vectorizer.none(),
+            properties=[
+                Property(name="document_name", data_type=DataType.TEXT),
+                Property(name="digest", data_type=DataType.TEXT),
+                Property(name="chunks", data_type=DataType.INT)
             ]
         )
-    client.close()
+    schema_ready = True
 
-setup_weaviate_schema()
+def save_file(stream: IO[bytes], file_path: str):
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(stream, buffer, 1 << 20)
+
+def file_digest(stream: IO[bytes]) -> str:
+    digest = hashlib.sha256()
+    while chunk := stream.read(1 << 20):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def find_document_file(document_name: str, digest: str):
+    collection = get_weaviate_client().collections.get("DocumentFile")
+    return collection.query.fetch_object_by_id(document_file_uuid(document_name, digest))
 
 @app.post("/upload")
-def upload(file: UploadFile = File(...)):
+async def upload(file: UploadFile = File(...)):
     filename = getattr(file, "filename", None) or getattr(file, "name", None)
     if not filename:
         raise HTTPException(status_code=400, detail="File does not have a valid filename")
@@ -84,25 +240,32 @@ def upload(file: UploadFile = File(...)):
     if file_extension not in ['pdf', 'docx', 'txt', 'json']:
         raise HTTPException(status_code=400, detail="Unsupported file format")
     
+    temp_dir = None
     try:
-        client= get_weaviate_client()
-        temp_dir = tempfile.mkdtemp()
-        temp_file_path = os.path.join(temp_dir, filename)
-        
-        # Save the file
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file if hasattr(file, "file") else file, buffer)
-        
-        delete_doc(filename)
-        
-        chunks = process_doc(temp_file_path, file_extension, filename)
+        stream = file.file if hasattr(file, "file") else file
+        await run_in_threadpool(setup_weaviate_schema)
 
-        collection = client.collections.get("DocumentChunk")
-        with collection.batch.dynamic() as batch:
-            for data_row in chunks:
-                batch.add_object(
-                    properties=data_row,
-                )
+        # Identical re-uploads are answered from the stored hash, skipping parsing, OCR and embedding
+        digest = await run_in_threadpool(file_digest, stream)
+        document_file = await run_in_threadpool(find_document_file, filename, digest)
+        if document_file is not None:
+            return {
+                "success": True,
+                "message": f"Document '{filename}' is unchanged, skipped processing",
+                "chunks": document_file.properties["chunks"]
+            }
+
+        if file_extension == "pdf":
+            # pdfplumber and the OCR workers need a real path, so only PDFs touch the disk.
+            # Save the file in 1MB pieces without blocking the event loop
+            temp_dir = tempfile.mkdtemp()
+            source = os.path.join(temp_dir, filename)
+            await run_in_threadpool(save_file, stream, source)
+        else:
+            source = stream
+        
+        # Parsing, OCR and ingest are blocking, so they run off the event loop
+        chunks = await run_in_threadpool(ingest_doc, source, file_extension, filename, digest)
     except Exception as e:
         return {
             "success": False,
@@ -110,8 +273,8 @@ def upload(file: UploadFile = File(...)):
         }
     finally:
         # Clean up the temporary file
-        shutil.rmtree(temp_dir)
-        client.close()
+        if temp_dir:
+            shutil.rmtree(temp_dir)
 
     return {
             "success": True,
@@ -119,63 +282,167 @@ def upload(file: UploadFile = File(...)):
             "chunks": len(chunks)
         }
 
+def ingest_doc(source: Union[str, IO[bytes]], file_type: str, file_name: str, digest: str) -> list:
+    client= get_weaviate_client()
+    collection = client.collections.get("DocumentChunk")
+
+    # A cheap count avoids a filtered delete across the collection for new filenames
+    existing = collection.aggregate.over_all(
+        filters=Filter.by_property("document_name").equal(file_name),
+        total_count=True
+    )
+    if existing.total_count > 0:
+        delete_doc(file_name)
+    
+    chunks = process_doc(source, file_type, file_name)
+
+    # Embedding all chunks locally in one batched call avoids a round trip to a
+    # hosted inference endpoint for every object
+    vectors = get_embedding_model().encode(
+        [data_row["text"] for data_row in chunks],
+        batch_size=64,
+        normalize_embeddings=True
+    )
+
+    with collection.batch.fixed_size(batch_size=100, concurrent_requests=4) as batch:
+        for data_row, vector in zip(chunks, vectors):
+            batch.add_object(
+                properties=data_row,
+                uuid=chunk_uuid(file_name, data_row["chunk_id"]),
+                vector={"document_vector": vector.tolist()},
+            )
+
+    # Never record a hash for a partial ingest, or a re-upload would skip the missing chunks
+    if collection.batch.failed_objects:
+        raise RuntimeError(f"{len(collection.batch.failed_objects)} chunks failed to upload")
+
+    # Empty documents aren't recorded: with no chunks the delete above would never clear their record
+    if chunks:
+        files = client.collections.get("DocumentFile")
+        # Keep a single record per filename: an overlapping upload of other bytes under
+        # the same name must not leave its hash behind to be matched later
+        files.data.delete_many(
+            where=Filter.by_property("document_name").equal(file_name)
+            & Filter.by_property("digest").not_equal(digest)
+        )
+        # insert_many goes through the batch API, which overwrites by uuid, so an
+        # overlapping upload of the same file that already wrote this record isn't an error
+        result = files.data.insert_many([
+            DataObject(
+                properties={"document_name": file_name, "digest": digest, "chunks": len(chunks)},
+                uuid=document_file_uuid(file_name, digest)
+            )
+        ])
+        if result.has_errors:
+            raise RuntimeError(f"Failed to record file hash: {list(result.errors.values())[0].message}")
+
+    return chunks
+
 @app.get("/query")
 def search(query: str, limit: int = 5):
+    setup_weaviate_schema()
     client = get_weaviate_client()
-    try:
-        collection = client.collections.get("DocumentChunk")
-        response = collection.query.near_text(
-            query=query,
-            limit=limit,
-            return_metadata=MetadataQuery(distance=True, certainty=True)
+    collection = client.collections.get("DocumentChunk")
+    # Hybrid search: BM25 over the chunk text does the wide recall pass and the
+    # cached query vector reranks it; Weaviate fuses the two scores
+    response = collection.query.hybrid(
+        query=query,
+        vector=list(embed_query(query)),
+        target_vector="document_vector",
+        query_properties=["text"],
+        alpha=0.75,
+        limit=limit,
+        return_metadata=MetadataQuery(score=True)
+    )
+
+    # Neighbouring chunks are stored by id only, so hydrate their text in one batched fetch
+    context_uuids = {}
+    for item in response.objects:
+        for key in ("context_before_id", "context_after_id"):
+            if item.properties.get(key) is not None:
+                context_uuids[(item.uuid, key)] = chunk_uuid(item.properties["document_name"], item.properties[key])
+
+    context_texts = {}
+    if context_uuids:
+        unique_uuids = list(set(context_uuids.values()))
+        neighbours = collection.query.fetch_objects(
+            filters=Filter.by_id().contains_any(unique_uuids),
+            limit=len(unique_uuids),
+            return_properties=["text"]
         )
-        results = []
-        for item in response.objects:
-            results.append({
-                "text": item.properties["text"],
-                "document_name": item.properties["document_name"],
-                "chunk_id": item.properties["chunk_id"],
-                "document_type": item.properties["document_type"],
-                "context_before": item.properties.get("context_before", ""),
-                "context_after": item.properties.get("context_after", ""),
-                "relevance_score": item.metadata.certainty,
-                "distance": item.metadata.distance
-            })
-    finally:
-        client.close()
+        context_texts = {str(obj.uuid): obj.properties["text"] for obj in neighbours.objects}
+
+    results = []
+    for item in response.objects:
+        results.append({
+            "text": item.properties["text"],
+            "document_name": item.properties["document_name"],
+            "chunk_id": item.properties["chunk_id"],
+            "document_type": item.properties["document_type"],
+            "context_before": context_texts.get(context_uuids.get((item.uuid, "context_before_id")), ""),
+            "context_after": context_texts.get(context_uuids.get((item.uuid, "context_after_id")), ""),
+            "relevance_score": item.metadata.score,
+            # Hybrid results carry a fused score but no vector distance; the key is
+            # kept so existing API clients don't break
+            "distance": None
+        })
         
     return {"results": results, "query": query}
 
 
 @app.delete("/delete")
 def delete_all():
-    try:
-        client= get_weaviate_client()
-        client.collections.delete("DocumentChunk")
-        setup_weaviate_schema()
-    finally:
-            client.close()
+    global schema_ready
+    client= get_weaviate_client()
+    client.collections.delete(["DocumentChunk", "DocumentFile"])
+    schema_ready = False
+    setup_weaviate_schema()
             
     return {"message": "All documents deleted successfully"}
     
 
-def process_doc(file_path: str, file_type: str, file_name: str) -> list:
+def read_text(source: Union[str, IO[bytes]]) -> str:
+    if isinstance(source, str):
+        with open(source, "r", encoding="utf-8") as f:
+            return f.read()
+    return source.read().decode("utf-8")
+
+def process_doc(source: Union[str, IO[bytes]], file_type: str, file_name: str) -> list:
+    # source is a path for PDFs and may be the uploaded file object for other formats
     text = ""
     if file_type == "pdf":
-        with pdfplumber.open(file_path) as pdf:
+        page_texts = []
+        ocr_pages = []
+        with pdfplumber.open(source) as pdf:
             for page in pdf.pages:
-                img = page.to_image(resolution=300).annotated
-                text += pytesseract.image_to_string(img) + "\n"
+                # page.chars comes straight from the parse, so counting it skips
+                # extract_text's layout pass on pages that are going to be OCR'd
+                if len(page.chars) < MIN_TEXT_LAYER_CHARS:
+                    ocr_pages.append(len(page_texts))
+                    page_text = ""
+                else:
+                    page_text = page.extract_text()
+                page_texts.append(page_text)
+                # Drop the parsed layout so large PDFs don't keep every page in memory
+                page.close()
+
+        # Tesseract is CPU-bound, so scanned pages are spread across processes
+        if ocr_pages:
+            logger.info(
+                "No usable text layer on %d of %d pages of %s, OCR'ing pages %s",
+                len(ocr_pages), len(page_texts), file_name, [i + 1 for i in ocr_pages]
+            )
+            ocr_texts = run_ocr(source, ocr_pages)
+            for page_index, page_text in zip(ocr_pages, ocr_texts):
+                page_texts[page_index] = page_text
+
+        text = "".join(page_text + "\n" for page_text in page_texts)
     elif file_type == "docx":
-        doc = docx.Document(file_path)
+        doc = docx.Document(source)
         text = " ".join([para.text for para in doc.paragraphs])
-    elif file_type == "json":
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            text = json.dumps(data)
-    elif file_type == "txt":
-        with open(file_path, "r", encoding="utf-8") as f:
-            text = f.read()
+    elif file_type in ("json", "txt"):
+        # JSON is indexed as written; parsing and re-serializing it only cost time
+        text = read_text(source)
 
     splitter = RecursiveCharacterTextSplitter(
             chunk_size=500,
@@ -185,19 +452,21 @@ def process_doc(file_path: str, file_type: str, file_name: str) -> list:
     
     chunks = splitter.split_text(text)
 
-    document_chunks = []
-    for i, chunk in enumerate(chunks):
-        context_before = chunks[i-1] if i > 0 else ""
-        context_after = chunks[i+1] if i < len(chunks)-1 else ""
-        document_chunks.append({
+    n = len(chunks)
+    before_ids = [None, *range(n - 1)]
+    after_ids = [*range(1, n), None]
+    document_chunks = [
+        {
             "text": chunk,
             "document_name": file_name,
             "chunk_id": i,
             "document_type": file_type,  
-            "total_chunks": len(chunks),
-            "context_before": context_before,
-            "context_after": context_after
-        })
+            "total_chunks": n,
+            "context_before_id": before_id,
+            "context_after_id": after_id
+        }
+        for i, (chunk, before_id, after_id) in enumerate(zip(chunks, before_ids, after_ids))
+    ]
     
     return document_chunks
 
@@ -208,7 +477,9 @@ def delete_doc(document_name: str):
         collection.data.delete_many(
             where=Filter.by_property("document_name").equal(document_name)
         )
+        # Drop the file hash too, otherwise re-uploading the old bytes would skip ingest
+        client.collections.get("DocumentFile").data.delete_many(
+            where=Filter.by_property("document_name").equal(document_name)
+        )
     except Exception as e:
-        print(f"Failed to delete document: {e}")
-    finally:
-        client.close()
\ No newline at end of file
+        print(f"Failed to delete document: {e}")
\ No newline at end of file
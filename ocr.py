@@ -0,0 +1,44 @@
+from dotenv import load_dotenv
+import os
+import fitz
+import tesserocr
+from PIL import Image
+from tesserocr import OEM, PSM
+
+# Kept apart from main.py so process pool workers started with "spawn" only import
+# what OCR needs, not the FastAPI app and its Weaviate setup.
+load_dotenv()
+
+# Point TESSDATA_PREFIX at a tessdata_fast checkout to use the fast integer models
+TESSDATA_PATH = os.getenv("TESSDATA_PREFIX") or tesserocr.get_languages()[0]
+
+_tesseract_api = None
+
+
+def get_tesseract_api():
+    # Loading the language model is the expensive part of Tesseract, so each worker
+    # process keeps one engine alive and reuses it for every page it is handed
+    global _tesseract_api
+    if _tesseract_api is None:
+        # LSTM-only (no legacy engine) and a single uniform block of text (PSM 6) skip
+        # the legacy recognizer and page layout analysis. This trades some recall on
+        # multi-column or mixed text/figure pages for much faster recognition.
+        _tesseract_api = tesserocr.PyTessBaseAPI(
+            path=TESSDATA_PATH,
+            lang="eng",
+            oem=OEM.LSTM_ONLY,
+            psm=PSM.SINGLE_BLOCK,
+        )
+    return _tesseract_api
+
+
+def ocr_page(file_path: str, page_index: int) -> str:
+    # MuPDF rasterizes the page directly; 200 DPI is plenty for Tesseract, and
+    # grayscale is a third of the bytes of RGB since Tesseract binarizes anyway
+    with fitz.open(file_path) as doc:
+        pix = doc[page_index].get_pixmap(dpi=200, colorspace=fitz.csGRAY)
+    img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+    api = get_tesseract_api()
+    api.SetImage(img)
+    return api.GetUTF8Text()